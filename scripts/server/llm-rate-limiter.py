@@ -9,236 +9,445 @@ Usage:
     ./llm-rate-limiter.py [--port 8080] [--backend http://localhost:8081] [--max-concurrent 5]
 
 The proxy accepts requests on the specified port and forwards them to the backend,
-limiting the number of concurrent requests to prevent GPU overload.
+limiting the number of concurrent requests to prevent GPU overload. Repeat
+--backend to spread requests across several llama-server instances; each new
+request goes to the backend with the fewest in flight.
+
+Requires aiohttp 3.12+ (pip install aiohttp). All connections are served from a single
+asyncio event loop, and requests to the backend share one pooled ClientSession.
+If uvloop is installed it is used as the event loop, and orjson is used for
+the proxy's own JSON responses.
 """
 
 import argparse
-import http.server
+import asyncio
 import json
 import logging
+import logging.handlers
 import queue
-import socketserver
-import threading
-import time
-import urllib.error
-import urllib.request
-from typing import Optional
+import socket
+from typing import List, Optional
+
+import aiohttp
+from aiohttp import http_parser, web
+from multidict import CIMultiDict, CIMultiDictProxy
+
+try:
+    import orjson
+except ImportError:  # Optional; stdlib json is just slower
+    orjson = None
 
 # Configuration
 DEFAULT_PORT = 8080
 DEFAULT_BACKEND = "http://localhost:8081"
 DEFAULT_MAX_CONCURRENT = 5
 DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_RPS = 0  # Requests/second released to the backend (0 = unlimited)
 REQUEST_TIMEOUT = 600  # 10 minutes for long generations
+READ_BUFFER_SIZE = 1 << 20  # Backend read buffer; bulk bodies move in up to 1 MiB writes
+# Seconds an idle backend connection stays pooled. Kept below llama-server's
+# own 5s keep-alive so we never reuse a socket the backend already closed.
+KEEPALIVE_TIMEOUT = 4
+# TCP keep-alive probing on backend sockets: a wedged or vanished backend is
+# detected after ~60s instead of waiting out REQUEST_TIMEOUT
+TCP_KEEPIDLE = 30
+TCP_KEEPINTVL = 10
+TCP_KEEPCNT = 3
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+}
+
+# Generation endpoints that take a rate limiter slot, matched on the end of the
+# path so llama-server's --api-prefix (e.g. /llama/v1/chat/completions) is covered:
+# OpenAI completions and chat, native /completion, Ollama-style /api/chat,
+# Anthropic-style /v1/messages, and /infill
+RATE_LIMITED_ENDPOINTS = ('/completions', '/completion', '/api/chat', '/messages', '/infill')
+
+# Full CORS preflight header block, built once and shared read-only
+PREFLIGHT_HEADERS = CIMultiDictProxy(CIMultiDict(CORS_HEADERS, **{'Content-Length': '0'}))
+
+# Request headers passed on to the backend (lower-cased). Compressed request
+# bodies are forwarded as-is, so their Content-Encoding goes along with them.
+FORWARD_HEADERS = frozenset(('content-type', 'authorization', 'accept', 'content-encoding'))
+
+# Response headers that describe the backend connection, not the body
+HOP_BY_HOP_HEADERS = frozenset((
+    'transfer-encoding', 'connection', 'keep-alive', 'upgrade',
+    'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+))
+# Content-Length is set again by aiohttp (or by us when streaming)
+SKIP_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | {'content-length'}
 
-# Logging setup
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
 logger = logging.getLogger(__name__)
 
 
-class RateLimiter:
-    """Semaphore-based rate limiter with queue monitoring."""
+def setup_logging() -> logging.handlers.QueueListener:
+    """Log through a queue so stream writes happen off the event loop thread."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Only merge args into the message here; the listener's handler does the rest
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def dump_json(obj: dict, pretty: bool = False) -> bytes:
+    """Serialize to JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    return json.dumps(obj, indent=2 if pretty else None).encode()
+
+
+class TokenBucket:
+    """Token bucket that spaces out admissions to a steady rate."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated: Optional[float] = None
+
+    async def take(self):
+        """Take a token, sleeping until one has accrued."""
+        now = asyncio.get_running_loop().time()
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        # Reserve the token up front so concurrent takers queue up behind
+        # each other instead of all waking at once
+        self.tokens -= 1
+        if self.tokens < 0:
+            try:
+                await asyncio.sleep(-self.tokens / self.rate)
+            except asyncio.CancelledError:
+                self.tokens += 1
+                raise
+
+
+class Backend:
+    """A llama-server instance and its rate-limited requests in flight."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.inflight = 0
 
-    def __init__(self, max_concurrent: int, queue_size: int):
-        self.semaphore = threading.Semaphore(max_concurrent)
+
+class RateLimiter:
+    """Semaphore-based rate limiter with queue monitoring.
+
+    Only touched from the event loop thread, so the counters need no lock.
+    With max_rps set, requests that get a slot are also released to the
+    backend at a steady rate, so freed slots don't all start prefill in the
+    same instant.
+
+    max_concurrent is per backend. The shared semaphore holds
+    max_concurrent slots for each backend, and every admitted request goes
+    to the least-loaded one, so no single backend ever has more than
+    max_concurrent requests in flight.
+    """
+
+    def __init__(self, backends: List[Backend], max_concurrent: int, queue_size: int,
+                 max_rps: float = 0):
+        self.backends = backends
+        self.semaphore = asyncio.Semaphore(max_concurrent * len(backends))
+        self.bucket = TokenBucket(max_rps) if max_rps > 0 else None
         self.max_concurrent = max_concurrent
+        self.max_rps = max_rps
         self.queue_size = queue_size
         self.waiting = 0
         self.active = 0
         self.total_requests = 0
-        self.lock = threading.Lock()
-
-    def acquire(self, timeout: Optional[float] = None) -> bool:
-        """Acquire a slot, blocking if necessary."""
-        with self.lock:
-            if self.waiting >= self.queue_size:
-                return False  # Queue full
-            self.waiting += 1
+        # Bumped on every counter change; keys the cached stats body
+        self._stats_version = 0
+        self._stats_cache = (-1, b'')
 
-        acquired = self.semaphore.acquire(timeout=timeout)
+    async def acquire(self, timeout: Optional[float] = None) -> Optional[Backend]:
+        """Acquire a slot, waiting if necessary, and pick the backend to use."""
+        if self.waiting >= self.queue_size:
+            return None  # Queue full
 
-        with self.lock:
+        self.waiting += 1
+        self._stats_version += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+            if self.bucket is not None:
+                try:
+                    await self.bucket.take()
+                except asyncio.CancelledError:
+                    self.semaphore.release()
+                    raise
+        except asyncio.TimeoutError:
+            return None
+        finally:
             self.waiting -= 1
-            if acquired:
-                self.active += 1
-                self.total_requests += 1
+            self._stats_version += 1
 
-        return acquired
+        backend = self.least_loaded()
+        backend.inflight += 1
+        self.active += 1
+        self.total_requests += 1
+        return backend
 
-    def release(self):
+    def release(self, backend: Backend):
         """Release a slot."""
-        with self.lock:
-            self.active -= 1
+        backend.inflight -= 1
+        self.active -= 1
+        self._stats_version += 1
         self.semaphore.release()
 
+    def least_loaded(self) -> Backend:
+        """Get the backend with the fewest requests in flight."""
+        return min(self.backends, key=lambda backend: backend.inflight)
+
     def stats(self) -> dict:
         """Get current stats."""
-        with self.lock:
-            return {
-                "active": self.active,
-                "waiting": self.waiting,
-                "max_concurrent": self.max_concurrent,
-                "total_requests": self.total_requests
-            }
-
-
-class ProxyHandler(http.server.BaseHTTPRequestHandler):
-    """HTTP request handler that proxies to backend with rate limiting."""
-
-    backend_url: str = DEFAULT_BACKEND
-    rate_limiter: RateLimiter = None
-
-    def log_message(self, format, *args):
-        """Override to use our logger."""
-        logger.info("%s - %s", self.address_string(), format % args)
-
-    def do_GET(self):
-        """Handle GET requests (health, metrics, models)."""
-        # Pass through without rate limiting for health checks
-        if self.path in ['/health', '/metrics', '/v1/models']:
-            self._proxy_request('GET')
-        elif self.path == '/proxy/stats':
-            self._send_stats()
-        else:
-            self._proxy_request('GET')
-
-    def do_POST(self):
-        """Handle POST requests (completions, chat) with rate limiting."""
-        # Rate limit inference requests
-        if '/completions' in self.path or '/chat' in self.path:
-            if not self.rate_limiter.acquire(timeout=REQUEST_TIMEOUT):
-                self._send_error(503, "Server overloaded - queue full")
-                return
-            try:
-                self._proxy_request('POST')
-            finally:
-                self.rate_limiter.release()
-        else:
-            self._proxy_request('POST')
-
-    def do_OPTIONS(self):
-        """Handle CORS preflight."""
-        self.send_response(200)
-        self._send_cors_headers()
-        self.end_headers()
-
-    def _send_cors_headers(self):
-        """Add CORS headers."""
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-
-    def _proxy_request(self, method: str):
-        """Proxy a request to the backend."""
-        url = f"{self.backend_url}{self.path}"
-
-        # Read request body for POST
-        body = None
-        if method == 'POST':
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length > 0:
-                body = self.rfile.read(content_length)
-
-        # Build the request
-        req = urllib.request.Request(url, data=body, method=method)
-
-        # Copy relevant headers
-        for header in ['Content-Type', 'Authorization', 'Accept']:
-            if header in self.headers:
-                req.add_header(header, self.headers[header])
-
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_rps": self.max_rps,
+            "total_requests": self.total_requests,
+            "backends": [{"url": backend.url, "inflight": backend.inflight}
+                         for backend in self.backends]
+        }
+
+    def stats_body(self) -> bytes:
+        """Get current stats as JSON, re-serialized only after a change."""
+        version, body = self._stats_cache
+        if version != self._stats_version:
+            body = dump_json(self.stats(), pretty=True)
+            self._stats_cache = (self._stats_version, body)
+        return body
+
+
+def backend_socket(addr_info) -> socket.socket:
+    """Create a backend socket with TCP keep-alive probing enabled."""
+    family, type_, proto, _, _ = addr_info
+    sock = socket.socket(family=family, type=type_, proto=proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):  # Linux
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPIDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPINTVL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPCNT)
+    return sock
+
+
+# Application state
+RATE_LIMITER = web.AppKey("rate_limiter", RateLimiter)
+CLIENT_SESSION = web.AppKey("client_session", aiohttp.ClientSession)
+
+
+async def handle_options(request: web.Request) -> web.Response:
+    """Answer a CORS preflight without touching the backend."""
+    return web.Response(headers=PREFLIGHT_HEADERS)
+
+
+async def handle(request: web.Request) -> web.StreamResponse:
+    """Proxy a request to the backend, rate limiting completions and chat."""
+    # Rate limit inference requests; health, metrics and models pass through
+    if request.method == 'POST' and request.path.rstrip('/').endswith(RATE_LIMITED_ENDPOINTS):
+        rate_limiter = request.app[RATE_LIMITER]
+        backend = await rate_limiter.acquire(timeout=REQUEST_TIMEOUT)
+        if backend is None:
+            return _send_error(503, "Server overloaded - queue full")
         try:
-            with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
-                # Send response status
-                self.send_response(response.status)
-
-                # Copy response headers
-                for header, value in response.getheaders():
-                    if header.lower() not in ['transfer-encoding', 'connection']:
-                        self.send_header(header, value)
-                self._send_cors_headers()
-                self.end_headers()
-
-                # Stream response body
-                while True:
-                    chunk = response.read(8192)
-                    if not chunk:
-                        break
-                    self.wfile.write(chunk)
-
-        except urllib.error.HTTPError as e:
-            self.send_response(e.code)
-            self._send_cors_headers()
-            self.end_headers()
-            self.wfile.write(e.read())
-        except urllib.error.URLError as e:
-            self._send_error(502, f"Backend error: {e.reason}")
-        except Exception as e:
-            self._send_error(500, f"Proxy error: {str(e)}")
-
-    def _send_error(self, code: int, message: str):
-        """Send an error response."""
-        self.send_response(code)
-        self.send_header('Content-Type', 'application/json')
-        self._send_cors_headers()
-        self.end_headers()
-        error_body = json.dumps({"error": {"message": message, "code": code}})
-        self.wfile.write(error_body.encode())
-
-    def _send_stats(self):
-        """Send rate limiter stats."""
-        stats = self.rate_limiter.stats()
-        self.send_response(200)
-        self.send_header('Content-Type', 'application/json')
-        self._send_cors_headers()
-        self.end_headers()
-        self.wfile.write(json.dumps(stats, indent=2).encode())
-
-
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    """Threaded HTTP server for handling concurrent connections."""
-    allow_reuse_address = True
-    daemon_threads = True
+            return await _proxy_request(request, backend)
+        finally:
+            rate_limiter.release(backend)
+
+    return await _proxy_request(request, request.app[RATE_LIMITER].least_loaded())
+
+
+async def _proxy_request(request: web.Request, backend: Backend) -> web.StreamResponse:
+    """Proxy a request to the backend."""
+    url = f"{backend.url}{request.raw_path}"
+
+    # Copy relevant headers
+    headers = {}
+    for header, value in request.headers.items():
+        if header.lower() in FORWARD_HEADERS:
+            headers[header] = value
+
+    # Stream the POST body through as it arrives instead of buffering it
+    body = None
+    if request.method == 'POST' and request.can_read_body:
+        body = request.content
+        if request.content_length is not None:
+            headers['Content-Length'] = str(request.content_length)
+
+    session = request.app[CLIENT_SESSION]
+    try:
+        upstream = await session.request(request.method, url, data=body, headers=headers)
+    except aiohttp.ClientConnectionError as e:
+        return _send_error(502, f"Backend error: {e}")
+    except Exception as e:
+        return _send_error(500, f"Proxy error: {str(e)}")
+
+    async with upstream:
+        # Copy response headers
+        response_headers = CIMultiDict(
+            [(header, value) for header, value in upstream.headers.items()
+             if header.lower() not in SKIP_RESPONSE_HEADERS]
+        )
+        response_headers.update(CORS_HEADERS)
+
+        content_type = upstream.headers.get('Content-Type', '')
+        if content_type.startswith('text/event-stream'):
+            return await _stream_events(request, upstream, response_headers)
+
+        if content_type.startswith('application/json'):
+            # Non-streaming completion: one buffered body, one write
+            try:
+                upstream_body = await upstream.read()
+            except aiohttp.ClientError as e:
+                return _send_error(502, f"Backend error: {e}")
+            return web.Response(status=upstream.status, reason=upstream.reason,
+                                body=upstream_body, headers=response_headers)
+
+        if upstream.content_length is not None:
+            response_headers['Content-Length'] = str(upstream.content_length)
+        response = web.StreamResponse(status=upstream.status, reason=upstream.reason,
+                                      headers=response_headers)
+        await response.prepare(request)
+
+        # Stream response body, forwarding whatever has been buffered so far
+        async for chunk in upstream.content.iter_any():
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+async def _stream_events(request: web.Request, upstream: aiohttp.ClientResponse,
+                         headers: CIMultiDict) -> web.StreamResponse:
+    """Relay a server-sent event stream, flushing each event as it arrives."""
+    headers['Cache-Control'] = 'no-cache'
+    headers['X-Accel-Buffering'] = 'no'
+    response = web.StreamResponse(status=upstream.status, reason=upstream.reason,
+                                  headers=headers)
+    # No Content-Length: aiohttp chunks this for HTTP/1.1 clients and falls
+    # back to a close-delimited body for HTTP/1.0 (e.g. behind default nginx)
+    await response.prepare(request)
+
+    # One write per backend send (a whole event) rather than one per line;
+    # iter_any() never holds data back waiting for more
+    async for chunk in upstream.content.iter_any():
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+def _send_error(code: int, message: str) -> web.Response:
+    """Build an error response."""
+    error_body = dump_json({"error": {"message": message, "code": code}})
+    return web.Response(status=code, body=error_body,
+                        content_type='application/json', headers=CORS_HEADERS)
+
+
+async def handle_stats(request: web.Request) -> web.Response:
+    """Send rate limiter stats."""
+    return web.Response(body=request.app[RATE_LIMITER].stats_body(),
+                        content_type='application/json', headers=CORS_HEADERS)
+
+
+def create_app(backend_urls: List[str], max_concurrent: int, queue_size: int,
+               max_rps: float = DEFAULT_MAX_RPS) -> web.Application:
+    """Build the proxy application."""
+    # Pass compressed request bodies through rather than inflating them here
+    app = web.Application(handler_args={'auto_decompress': False})
+    backends = [Backend(url) for url in backend_urls]
+    app[RATE_LIMITER] = RateLimiter(backends, max_concurrent, queue_size, max_rps)
+
+    async def client_session(app: web.Application):
+        # One pooled session for the lifetime of the proxy: room for every
+        # rate-limited slot plus as many pass-through health/model calls,
+        # per backend. aiohttp already sets TCP_NODELAY on both client and
+        # server sockets.
+        connector = aiohttp.TCPConnector(limit=max_concurrent * 2 * len(backends),
+                                         limit_per_host=max_concurrent * 2,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                         socket_factory=backend_socket)
+        app[CLIENT_SESSION] = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=REQUEST_TIMEOUT),
+            # Never decode backend bodies: don't ask for compression, and if the
+            # backend compresses anyway, pass the bytes through untouched
+            skip_auto_headers=('Accept-Encoding',),
+            auto_decompress=False,
+            read_bufsize=READ_BUFFER_SIZE,
+        )
+        yield
+        await app[CLIENT_SESSION].close()
+
+    app.cleanup_ctx.append(client_session)
+    app.router.add_get('/proxy/stats', handle_stats)
+    app.router.add_options('/{tail:.*}', handle_options)
+    for method in ('GET', 'POST'):
+        app.router.add_route(method, '/{tail:.*}', handle)
+    return app
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Create the event loop, preferring uvloop when it is installed."""
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
 
 
 def main():
     parser = argparse.ArgumentParser(description='LLM Rate Limiter Proxy')
     parser.add_argument('--port', type=int, default=DEFAULT_PORT,
                         help=f'Port to listen on (default: {DEFAULT_PORT})')
-    parser.add_argument('--backend', type=str, default=DEFAULT_BACKEND,
-                        help=f'Backend URL (default: {DEFAULT_BACKEND})')
+    parser.add_argument('--backend', type=str, action='append', dest='backends',
+                        help=f'Backend URL, repeat for multiple backends (default: {DEFAULT_BACKEND})')
     parser.add_argument('--max-concurrent', type=int, default=DEFAULT_MAX_CONCURRENT,
-                        help=f'Max concurrent requests (default: {DEFAULT_MAX_CONCURRENT})')
+                        help=f'Max concurrent requests per backend (default: {DEFAULT_MAX_CONCURRENT})')
     parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
                         help=f'Max queued requests (default: {DEFAULT_QUEUE_SIZE})')
+    parser.add_argument('--max-rps', type=float, default=DEFAULT_MAX_RPS,
+                        help='Max requests/second released to the backend, '
+                             'smooths bursts when slots free up (default: 0 = unlimited)')
     args = parser.parse_args()
+    backends = args.backends or [DEFAULT_BACKEND]
 
-    # Configure the handler
-    ProxyHandler.backend_url = args.backend
-    ProxyHandler.rate_limiter = RateLimiter(args.max_concurrent, args.queue_size)
-
-    # Start the server
-    server = ThreadedHTTPServer(('0.0.0.0', args.port), ProxyHandler)
+    log_listener = setup_logging()
+    app = create_app(backends, args.max_concurrent, args.queue_size, args.max_rps)
+    loop = new_event_loop()
 
     logger.info("=" * 60)
     logger.info("LLM Rate Limiter Proxy")
     logger.info("=" * 60)
     logger.info(f"Listening on: http://0.0.0.0:{args.port}")
-    logger.info(f"Backend: {args.backend}")
-    logger.info(f"Max concurrent requests: {args.max_concurrent}")
+    logger.info(f"Backend: {', '.join(backends)}")
+    logger.info(f"Max concurrent requests: {args.max_concurrent} per backend")
     logger.info(f"Queue size: {args.queue_size}")
+    logger.info(f"Max requests/second: {args.max_rps or 'unlimited'}")
+    logger.info(f"Event loop: {type(loop).__module__}.{type(loop).__name__}")
     logger.info(f"Stats endpoint: http://localhost:{args.port}/proxy/stats")
     logger.info("=" * 60)
 
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        logger.info("Shutting down...")
-        server.shutdown()
+    # aiohttp silently falls back to a pure-Python parser without its C build
+    if not hasattr(http_parser, 'HttpRequestParserC'):
+        logger.warning("aiohttp C extensions unavailable - using the slow pure-Python HTTP parser")
+
+    web.run_app(app, host='0.0.0.0', port=args.port, loop=loop, print=None,
+                access_log=logger, access_log_format='%a - "%r" %s %b')
+    logger.info("Shutting down...")
+    log_listener.stop()
 
 
 if __name__ == '__main__':